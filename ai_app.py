@@ -1,27 +1,106 @@
 from __future__ import annotations
 
+import atexit
+import base64
+import hashlib
+import io
 import os
+import re
+import threading
+import time
 import uuid
 import shutil
+import wave
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable
+from types import SimpleNamespace
+from typing import Callable, Iterable, Iterator
 
 from flask import Blueprint, current_app, jsonify, render_template, request, session, url_for
-from flask_login import login_required
+from flask_login import current_user, login_required
 import ffmpeg  # type: ignore
+import orjson
 import requests
-import speech_recognition as sr
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
 
 from gtts import gTTS  # type: ignore
 
+try:
+    import av  # type: ignore
+    _AV_ERRORS: tuple[type[Exception], ...] = (av.error.FFmpegError,)
+except ImportError:  # pragma: no cover - optional dependency
+    av = None
+    _AV_ERRORS = ()
+
+try:
+    from piper import PiperVoice  # type: ignore
+except ImportError:  # pragma: no cover - optional dependency
+    PiperVoice = None
+
 bp = Blueprint("ai", __name__, url_prefix="/aicompanion")
 
 _GEMINI_MODEL = "gemini-2.0-flash"
 _GEMINI_ENDPOINT = (
     "https://generativelanguage.googleapis.com/v1beta/models/"
-    f"{_GEMINI_MODEL}:generateContent"
+    f"{_GEMINI_MODEL}:streamGenerateContent"
 )
+_SPEECH_ENDPOINT = "https://speech.googleapis.com/v1/speech:recognize"
+_ROLE_LABELS = {"system": "System", "user": "User", "assistant": "Assistant"}
+
+_SAMPLE_RATE = 16000
+_AUDIO_SUFFIXES = (".mp3", ".wav", ".webm")
+
+# Replies for repeated (conversation so far, utterance) exchanges such as
+# opening greetings, so those turns skip the Gemini round-trip entirely. The
+# key covers the whole bounded history, so a reply that depends on earlier
+# turns is never replayed into a different conversation, and entries expire
+# after AI_RESPONSE_CACHE_TTL seconds so time-sensitive answers go stale.
+_RESPONSE_CACHE: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+_RESPONSE_CACHE_LOCK = threading.Lock()
+_UTTERANCE_PATTERN = re.compile(r"[^a-z0-9\s]")
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+# Synthesised audio for recurring replies, keyed on a hash of (voice, text).
+# Cached files are named with _TTS_CACHE_PREFIX and outlive playback; the
+# least recently used ones are deleted once the cache is full.
+_TTS_CACHE_PREFIX = "tts_"
+_TTS_CACHE: OrderedDict[str, Path] = OrderedDict()
+_TTS_CACHE_LOCK = threading.Lock()
+
+_JOBS_LOCK = threading.Lock()
+
+# Conversation history per browser session, kept server-side so the cookie
+# does not carry (and re-serialise) the whole conversation on every turn.
+# Each entry carries its word count so the history can be kept within
+# AI_HISTORY_MAX_WORDS as it grows instead of being re-scanned every turn.
+_HISTORY: OrderedDict[str, dict] = OrderedDict()
+_HISTORY_LOCK = threading.Lock()
+
+
+def _build_session(pool_connections: int, pool_maxsize: int) -> requests.Session:
+    """Create the shared HTTP session used for all outbound Google API calls.
+
+    Pooled keep-alive connections avoid a fresh TCP+TLS handshake per turn.
+    The pool is sized to the number of worker threads expected to call out
+    concurrently so threaded workers never queue behind a single socket.
+    """
+
+    session_ = requests.Session()
+    # Retries are handled by call_gemini_api, so the adapter must not retry.
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=0),
+    )
+    session_.mount("https://", adapter)
+    return session_
+
+
+def _http_session() -> requests.Session:
+    return current_app.extensions["ai_http"]
 
 
 def init_app(app) -> None:
@@ -34,14 +113,17 @@ def init_app(app) -> None:
 
     audio_folder = Path(app.root_path, "static", "audio")
     video_folder = Path(app.root_path, "static", "video")
-    tmp_folder = Path(app.root_path, "tmp")
 
-    for folder in (audio_folder, video_folder, tmp_folder):
+    for folder in (audio_folder, video_folder):
         folder.mkdir(parents=True, exist_ok=True)
 
     app.config.setdefault("AI_UPLOAD_FOLDER", str(audio_folder))
     app.config.setdefault("AI_VIDEO_FOLDER", str(video_folder))
-    app.config.setdefault("AI_TMP_FOLDER", str(tmp_folder))
+    # Resolved once here so request handlers never rebuild these Paths.
+    app.extensions["ai_paths"] = SimpleNamespace(
+        audio=Path(app.config["AI_UPLOAD_FOLDER"]),
+        video=Path(app.config["AI_VIDEO_FOLDER"]),
+    )
 
     ffmpeg_bin = shutil.which("ffmpeg")
     if not ffmpeg_bin:
@@ -54,91 +136,264 @@ def init_app(app) -> None:
         raise RuntimeError("Missing GOOGLE_API_KEY environment variable.")
     app.config["GOOGLE_API_KEY"] = api_key
 
-    gemini_url = f"{_GEMINI_ENDPOINT}?key={api_key}"
+    gemini_url = f"{_GEMINI_ENDPOINT}?alt=sse&key={api_key}"
     app.config.setdefault("GEMINI_API_URL", gemini_url)
+    app.config.setdefault("SPEECH_API_URL", f"{_SPEECH_ENDPOINT}?key={api_key}")
+    app.config.setdefault("AI_SPEECH_LANGUAGE", "en-US")
     app.config.setdefault(
         "AI_SYSTEM_PROMPT", "You are restricted to respond in 20 words."
     )
 
+    voice_path = app.config.get("AI_PIPER_VOICE") or os.getenv("AI_PIPER_VOICE")
+    if voice_path and PiperVoice is not None and "ai_tts" not in app.extensions:
+        try:
+            app.extensions["ai_tts"] = PiperVoice.load(voice_path)
+        except Exception as exc:  # pragma: no cover - startup safety
+            app.logger.warning("Piper voice could not be loaded, using gTTS: %s", exc)
+
+    # Record uncompressed 16 kHz WAV in the browser instead of 32 kbps Opus.
+    # Uploads are ~8x larger, so this is only worth it on fast local links.
+    app.config.setdefault("AI_RECORD_WAV", False)
+    app.config.setdefault("AI_TTS_FORMAT", "webm")
+    app.config.setdefault("AI_TTS_OPUS_BITRATE", 24000)
+    app.config.setdefault("AI_RESPONSE_CACHE_SIZE", 256)
+    app.config.setdefault("AI_RESPONSE_CACHE_TTL", 300)
+    app.config.setdefault("AI_TTS_CACHE_SIZE", 512)
+    _load_tts_cache(app.extensions["ai_paths"].audio, app.config["AI_TTS_CACHE_SIZE"])
+    app.config.setdefault("AI_HISTORY_MAX_MESSAGES", 50)
+    app.config.setdefault("AI_HISTORY_MAX_WORDS", 3000)
+    app.config.setdefault("AI_HISTORY_MAX_SESSIONS", 1024)
+    app.config.setdefault("AI_PIPELINE_WORKERS", min(8, (os.cpu_count() or 1) * 2))
+    app.config.setdefault("AI_JOB_TTL", 300)
+    app.config.setdefault("AI_TTS_WORKERS", 4)
+    if "ai_tts_executor" not in app.extensions:
+        tts_executor = ThreadPoolExecutor(
+            max_workers=app.config["AI_TTS_WORKERS"], thread_name_prefix="ai-tts"
+        )
+        app.extensions["ai_tts_executor"] = tts_executor
+        atexit.register(tts_executor.shutdown, wait=False)
+    if "ai_executor" not in app.extensions:
+        executor = ThreadPoolExecutor(
+            max_workers=app.config["AI_PIPELINE_WORKERS"], thread_name_prefix="ai-pipeline"
+        )
+        app.extensions["ai_executor"] = executor
+        app.extensions["ai_jobs"] = {}
+        atexit.register(executor.shutdown, wait=False)
+    app.config.setdefault("AI_HTTP_POOL_CONNECTIONS", 10)
+    app.config.setdefault("AI_HTTP_POOL_MAXSIZE", 20)
+    if "ai_http" not in app.extensions:
+        http = _build_session(
+            app.config["AI_HTTP_POOL_CONNECTIONS"], app.config["AI_HTTP_POOL_MAXSIZE"]
+        )
+        app.extensions["ai_http"] = http
+        atexit.register(http.close)
+
 
 @bp.get("/")
 @login_required
 def ai_home():
     """Render the conversational AI Companion interface."""
-    return render_template("ai.html")
+    return render_template("ai.html", record_wav=current_app.config["AI_RECORD_WAV"])
 
 
 @bp.post("/process_audio")
 @login_required
 def process_audio():
-    """Handle audio submissions from the AI Companion interface."""
+    """Queue an audio submission from the AI Companion interface.
+
+    The STT -> Gemini -> TTS pipeline runs on the module's worker pool so the
+    request thread is released immediately; the client polls the returned
+    ``result_url`` until the reply is ready.
+    """
+
+    audio_file = request.files.get("audio_data")
+    if not audio_file:
+        return jsonify({"error": "No audio_data provided"}), 400
+
+    try:
+        audio_bytes = audio_file.read()
+        # History now lives server-side; drop any copy left in the cookie.
+        session.pop("history", None)
+        app = current_app._get_current_object()
+        owner = current_user.get_id()
+        future = app.extensions["ai_executor"].submit(
+            _run_pipeline, app, audio_bytes, _history_key(), owner
+        )
+        job_id = _register_job(future, owner)
+    except Exception as exc:  # pragma: no cover - surfaces to JSON error payload
+        current_app.logger.exception("process_audio error")
+        return jsonify({"error": str(exc)}), 500
 
-    history = list(session.get("history", []))
-    system_msg = {
-        "author": "system",
-        "text": current_app.config.get(
-            "AI_SYSTEM_PROMPT", "You are restricted to respond in 20 words."
+    return (
+        jsonify(
+            {
+                "job_id": job_id,
+                "result_url": url_for("ai.pipeline_result", job_id=job_id),
+            }
         ),
-    }
+        202,
+    )
+
+
+@bp.get("/result/<job_id>")
+@login_required
+def pipeline_result(job_id: str):
+    """Report the state of a queued pipeline job, returning the reply once done.
+
+    The reply text is returned as soon as it has been generated; each audio
+    segment is still being synthesised and is exposed as a ``status_url`` the
+    client polls until the file is ready.
+    """
+
+    future, pending = _finished_job(job_id)
+    if pending is not None:
+        return pending
 
     try:
-        audio_file = request.files.get("audio_data")
-        if not audio_file:
-            return jsonify({"error": "No audio_data provided"}), 400
+        result = future.result()
+    except Exception as exc:  # pragma: no cover - surfaces to JSON error payload
+        return jsonify({"error": str(exc)}), 500
+
+    return jsonify(
+        {
+            "status": "done",
+            "transcript": result["transcript"],
+            "response_text": result["response_text"],
+            "audio": [
+                {"status_url": url_for("ai.audio_status", job_id=segment_id)}
+                for segment_id in result["audio_jobs"]
+            ],
+            "loop_video_url": url_for("static", filename="video/demo.mp4"),
+        }
+    )
+
+
+@bp.get("/audio_status/<job_id>")
+@login_required
+def audio_status(job_id: str):
+    """Report whether a reply audio segment has finished synthesising."""
+
+    future, pending = _finished_job(job_id)
+    if pending is not None:
+        return pending
+
+    try:
+        audio_path = future.result()
+    except Exception as exc:  # pragma: no cover - surfaces to JSON error payload
+        return jsonify({"error": str(exc)}), 500
+
+    return jsonify(
+        {
+            "status": "ready",
+            "url": url_for("static", filename=f"audio/{audio_path.name}"),
+            "filename": audio_path.name,
+        }
+    )
 
-        tmp_folder = Path(current_app.config["AI_TMP_FOLDER"])
-        webm_path = tmp_folder / f"{uuid.uuid4().hex}.webm"
-        audio_file.save(webm_path)
 
-        wav_path = webm_path.with_suffix(".wav")
-        ffmpeg.input(str(webm_path)).output(
-            str(wav_path), ac=1, ar=16000
-        ).run(quiet=True, overwrite_output=True)
+def _run_pipeline(app, audio_bytes: bytes, history_key: str, owner: str) -> dict:
+    """Transcribe a recording and generate the reply, queueing its audio.
 
-        recognizer = sr.Recognizer()
-        with sr.AudioFile(str(wav_path)) as src:
-            audio_data = recognizer.record(src)
+    Synthesis runs on the TTS pool and is not awaited here; each segment is
+    registered as its own job so the reply text can be returned immediately.
+    """
 
+    with app.app_context():
         try:
-            transcript = recognizer.recognize_google(audio_data)
-        except sr.UnknownValueError:
-            transcript = ""
-        except sr.RequestError as exc:  # pragma: no cover - upstream failure
-            raise RuntimeError(f"Speech recognition error: {exc}")
+            history = _get_history(history_key)
+            system_msg = {
+                "author": "system",
+                "text": current_app.config.get(
+                    "AI_SYSTEM_PROMPT", "You are restricted to respond in 20 words."
+                ),
+            }
 
-        history.append({"author": "user", "text": transcript})
-        session["history"] = history
+            transcript = recognize_speech(_load_audio(audio_bytes))
+
+            cache_key = _response_cache_key(history, transcript)
+            history = history + [{"author": "user", "text": transcript}]
+
+            # Each sentence is synthesised as soon as it is complete, so TTS
+            # overlaps the rest of the reply still streaming from Gemini.
+            audio_folder = current_app.extensions["ai_paths"].audio
+            tts_executor = app.extensions["ai_tts_executor"]
+            segments = []
+
+            def speak(sentence: str) -> None:
+                sentence = sentence.strip()
+                if sentence:
+                    segments.append(
+                        tts_executor.submit(_synthesize_segment, app, sentence, audio_folder)
+                    )
+
+            response_text = _cached_response(cache_key)
+            if response_text is None:
+                response_text = _stream_reply([system_msg] + history, speak)
+                _remember_response(cache_key, response_text)
+            else:
+                for sentence in _SENTENCE_BOUNDARY.split(response_text):
+                    speak(sentence)
+
+            _append_history(
+                history_key,
+                {"author": "user", "text": transcript},
+                {"author": "assistant", "text": response_text},
+            )
+
+            audio_jobs = [_register_job(segment, owner) for segment in segments]
+        except Exception:
+            current_app.logger.exception("process_audio error")
+            raise
 
-        messages = _truncate_history([system_msg] + history)
-        response_text = call_gemini_api(messages).replace("*", "")
+    return {
+        "transcript": transcript,
+        "response_text": response_text,
+        "audio_jobs": audio_jobs,
+    }
 
-        history.append({"author": "assistant", "text": response_text})
-        session["history"] = history
 
-        webm_path.unlink(missing_ok=True)
-        wav_path.unlink(missing_ok=True)
+def _synthesize_segment(app, text: str, audio_folder: Path) -> Path:
+    with app.app_context():
+        try:
+            return _synthesize_cached(text, audio_folder)
+        except Exception:
+            current_app.logger.exception("reply synthesis error")
+            raise
 
-        audio_folder = Path(current_app.config["AI_UPLOAD_FOLDER"])
-        mp3_path = audio_folder / f"resp_{uuid.uuid4().hex}.mp3"
-        synthesize_conversational(response_text, mp3_path)
 
-        audio_url = url_for("static", filename=f"audio/{mp3_path.name}")
-        loop_video_url = url_for("static", filename="video/demo.mp4")
+def _register_job(future, owner: str) -> str:
+    """Track a submitted job for ``owner``, dropping results nobody collected."""
 
-        return jsonify(
-            {
-                "transcript": transcript,
-                "response_text": response_text,
-                "audio_url": audio_url,
-                "audio_filename": mp3_path.name,
-                "loop_video_url": loop_video_url,
-            }
-        )
+    jobs = current_app.extensions["ai_jobs"]
+    ttl = current_app.config.get("AI_JOB_TTL", 300)
+    now = time.monotonic()
+    job_id = uuid.uuid4().hex
+    with _JOBS_LOCK:
+        for stale_id in [
+            key for key, job in jobs.items() if job["future"].done() and now - job["created"] > ttl
+        ]:
+            del jobs[stale_id]
+        jobs[job_id] = {"future": future, "owner": owner, "created": now}
+    return job_id
 
-    except Exception as exc:  # pragma: no cover - surfaces to JSON error payload
-        current_app.logger.exception("process_audio error")
-        return jsonify({"error": str(exc)}), 500
 
+def _finished_job(job_id: str):
+    """Claim the current user's finished job.
+
+    Returns ``(future, None)`` once the job is done, removing it from the
+    registry, or ``(None, response)`` with a 404 or 202 pending response.
+    """
+
+    owner = current_user.get_id()
+    jobs = current_app.extensions["ai_jobs"]
+    with _JOBS_LOCK:
+        job = jobs.get(job_id)
+        if job is None or job["owner"] != owner:
+            return None, (jsonify({"error": "Unknown job"}), 404)
+        if not job["future"].done():
+            return None, (jsonify({"status": "pending"}), 202)
+        del jobs[job_id]
+    return job["future"], None
 
 
 @bp.post("/cleanup_audio")
@@ -153,11 +408,14 @@ def cleanup_audio():
             return jsonify({"error": "Filename required"}), 400
 
         filename = os.path.basename(original)
-        if filename != original or not filename.endswith('.mp3'):
+        if filename != original or not filename.endswith(_AUDIO_SUFFIXES):
             return jsonify({"error": "Invalid filename"}), 400
 
-        audio_folder = Path(current_app.config["AI_UPLOAD_FOLDER"])
-        file_path = audio_folder / filename
+        if filename.startswith(_TTS_CACHE_PREFIX):
+            # Shared cached audio is evicted by the TTS cache, not by clients.
+            return jsonify({"status": "ok"})
+
+        file_path = current_app.extensions["ai_paths"].audio / filename
         if file_path.exists():
             file_path.unlink()
         return jsonify({"status": "ok"})
@@ -167,48 +425,60 @@ def cleanup_audio():
 
 
 def call_gemini_api(message_list: Iterable[dict], retries: int = 3, backoff: float = 1.0) -> str:
-    """Send a prompt to the Gemini API with lightweight retry handling."""
+    """Send a prompt to the Gemini API and return the complete reply text."""
 
-    import time
+    return "".join(stream_gemini_api(message_list, retries=retries, backoff=backoff))
 
-    lines = []
-    for msg in message_list:
-        author = msg.get("author", "assistant") or "assistant"
-        speaker = (
-            "System" if author == "system" else "User" if author == "user" else "Assistant"
-        )
-        lines.append(f"{speaker}: {msg.get('text', '')}")
+
+def stream_gemini_api(
+    message_list: Iterable[dict], retries: int = 3, backoff: float = 1.0
+) -> Iterator[str]:
+    """Yield reply text from Gemini's SSE stream as it is generated.
+
+    Failed attempts are retried with exponential backoff as long as no text
+    has been yielded yet; once output has started, errors propagate.
+    """
+
+    lines = [
+        f"{_ROLE_LABELS.get(msg.get('author'), 'Assistant')}: {msg.get('text', '')}"
+        for msg in message_list
+    ]
     lines.append("Assistant:")
 
     payload = {"contents": [{"parts": [{"text": "\n".join(lines)}]}]}
+    body = orjson.dumps(payload)
     headers = {"Content-Type": "application/json"}
     api_url = current_app.config["GEMINI_API_URL"]
+    http = _http_session()
 
     last_exc: Exception | None = None
     for attempt in range(1, retries + 1):
+        started = False
         try:
-            response = requests.post(api_url, headers=headers, json=payload, timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            candidates = data.get("candidates") or []
-            if not candidates:
+            with http.post(
+                api_url, headers=headers, data=body, timeout=(3.05, 15), stream=True
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    text = _candidate_text(orjson.loads(line[5:]))
+                    if text:
+                        started = True
+                        yield text
+            if not started:
                 raise RuntimeError("No response from Gemini API")
-            content = candidates[0].get("content")
-            if isinstance(content, dict) and "text" in content:
-                return content["text"]
-            if isinstance(content, dict):
-                return "".join(part.get("text", "") for part in content.get("parts", []))
-            return str(content)
+            return
         except HTTPError as exc:
             last_exc = exc
             status = getattr(exc.response, "status_code", None)
-            if status == 503 and attempt < retries:
+            if status == 503 and attempt < retries and not started:
                 time.sleep(backoff * (2 ** (attempt - 1)))
                 continue
             raise
         except Exception as exc:  # pragma: no cover - guards transient issues
             last_exc = exc
-            if attempt < retries:
+            if attempt < retries and not started:
                 time.sleep(backoff * (2 ** (attempt - 1)))
                 continue
             raise
@@ -218,9 +488,136 @@ def call_gemini_api(message_list: Iterable[dict], retries: int = 3, backoff: flo
     raise RuntimeError("Gemini API call failed")
 
 
+def _candidate_text(data: dict) -> str:
+    candidates = data.get("candidates") or []
+    if not candidates:
+        return ""
+    content = candidates[0].get("content")
+    if isinstance(content, dict) and "text" in content:
+        return content["text"]
+    if isinstance(content, dict):
+        return "".join(part.get("text", "") for part in content.get("parts", []))
+    return str(content) if content else ""
+
+
+def _stream_reply(message_list: list[dict], on_sentence: Callable[[str], None]) -> str:
+    """Stream a Gemini reply, handing each sentence to ``on_sentence`` as it completes."""
+
+    parts: list[str] = []
+    pending = ""
+    for delta in stream_gemini_api(message_list):
+        delta = delta.replace("*", "")
+        parts.append(delta)
+        *complete, pending = _SENTENCE_BOUNDARY.split(pending + delta)
+        for sentence in complete:
+            on_sentence(sentence)
+    on_sentence(pending)
+    return "".join(parts)
+
+
+def _load_audio(audio_bytes: bytes) -> bytes:
+    """Decode an uploaded recording into 16 kHz mono 16-bit PCM.
+
+    The page uploads webm/opus, or 16 kHz mono WAV (used unchanged) when
+    ``AI_RECORD_WAV`` is enabled. Compressed uploads are decoded in-process
+    from memory by PyAV; without PyAV the bytes are piped through an ffmpeg subprocess
+    (stdin -> raw PCM on stdout), so no path touches the filesystem.
+    """
+
+    pcm = _wav_pcm(audio_bytes)
+    if pcm is not None:
+        return pcm
+
+    if av is not None:
+        return _decode_pcm(audio_bytes)
 
-def synthesize_conversational(text: str, out_path: Path | str) -> None:
-    '''Create a spoken response for the assistant reply.'''
+    pcm, _ = (
+        ffmpeg.input("pipe:0")
+        .output("pipe:1", format="s16le", ac=1, ar=_SAMPLE_RATE)
+        .run(input=audio_bytes, capture_stdout=True, capture_stderr=True)
+    )
+    return pcm
+
+
+def _wav_pcm(data: bytes) -> bytes | None:
+    """Return the frames of a 16 kHz mono 16-bit WAV, or None for anything else."""
+
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav:
+            if (wav.getframerate(), wav.getnchannels(), wav.getsampwidth()) != (_SAMPLE_RATE, 1, 2):
+                return None
+            return wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+
+
+def _decode_pcm(data: bytes) -> bytes:
+    """Return 16-bit mono PCM at ``_SAMPLE_RATE`` for any container PyAV reads."""
+
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=_SAMPLE_RATE)
+    pcm = bytearray()
+    with av.open(io.BytesIO(data)) as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                # Plane buffers are padded; keep only the real samples.
+                pcm += bytes(resampled.planes[0])[: resampled.samples * 2]
+        for resampled in resampler.resample(None):
+            pcm += bytes(resampled.planes[0])[: resampled.samples * 2]
+    return bytes(pcm)
+
+
+def recognize_speech(pcm: bytes) -> str:
+    """Transcribe 16 kHz mono LINEAR16 audio with the Cloud Speech REST API.
+
+    The raw PCM is posted as-is over the shared pooled session, so there is no
+    FLAC encoding step and the TLS connection to Google is reused.
+    """
+
+    if not pcm:
+        return ""
+
+    payload = {
+        "config": {
+            "encoding": "LINEAR16",
+            "sampleRateHertz": _SAMPLE_RATE,
+            "languageCode": current_app.config.get("AI_SPEECH_LANGUAGE", "en-US"),
+        },
+        "audio": {"content": base64.b64encode(pcm).decode("ascii")},
+    }
+    try:
+        response = _http_session().post(
+            current_app.config["SPEECH_API_URL"],
+            headers={"Content-Type": "application/json"},
+            data=orjson.dumps(payload),
+            timeout=(3.05, 15),
+        )
+        response.raise_for_status()
+    except requests.RequestException as exc:  # pragma: no cover - upstream failure
+        raise RuntimeError(f"Speech recognition error: {exc}")
+
+    # Longer recordings come back as consecutive results, one per segment.
+    results = orjson.loads(response.content).get("results") or []
+    parts = []
+    for result in results:
+        alternatives = result.get("alternatives") or []
+        if alternatives:
+            parts.append((alternatives[0].get("transcript") or "").strip())
+    return " ".join(part for part in parts if part)
+
+
+def synthesize_conversational(text: str, out_path: Path | str) -> Path:
+    '''Create a spoken response for the assistant reply.
+
+    A local Piper voice (configured via ``AI_PIPER_VOICE``) synthesises WAV
+    in-process; otherwise gTTS produces MP3. With ``AI_TTS_FORMAT`` set to
+    ``"webm"`` (the default) the audio is re-encoded to low-bitrate Opus,
+    which is several times smaller for speech; PyAV encodes it in-process
+    and an ffmpeg subprocess is only used when PyAV is unavailable. The
+    suffix of ``out_path`` is adjusted to the format written and the final
+    path is returned.
+    '''
 
     path = Path(out_path)
     words = text.split()
@@ -228,20 +625,232 @@ def synthesize_conversational(text: str, out_path: Path | str) -> None:
         text = " ".join(words[:150]) + "..."
 
     path.parent.mkdir(parents=True, exist_ok=True)
-    gTTS(text=text, lang="en").save(str(path))
-
-def _truncate_history(messages: list[dict]) -> list[dict]:
-    total_words = 0
-    trimmed: list[dict] = []
-    for entry in reversed(messages):
-        words = len((entry.get("text") or "").split())
-        if total_words + words > 3000 and trimmed:
-            break
-        trimmed.append(entry)
-        total_words += words
-    return list(reversed(trimmed))
-
-
-__all__ = ["bp", "init_app", "call_gemini_api", "cleanup_audio", "synthesize_conversational"]
+    buffer = io.BytesIO()
+    voice = current_app.extensions.get("ai_tts")
+    if voice is not None:
+        native_suffix = ".wav"
+        with wave.open(buffer, "wb") as wav_file:
+            if hasattr(voice, "synthesize_wav"):  # piper-tts >= 1.3
+                voice.synthesize_wav(text, wav_file)
+            else:
+                voice.synthesize(text, wav_file)
+    else:
+        native_suffix = ".mp3"
+        gTTS(text=text, lang="en").write_to_fp(buffer)
+    audio = buffer.getvalue()
+
+    if current_app.config.get("AI_TTS_FORMAT") == "webm":
+        opus_path = path.with_suffix(".webm")
+        bit_rate = int(current_app.config.get("AI_TTS_OPUS_BITRATE", 24000))
+        try:
+            if av is not None:
+                opus_path.write_bytes(_encode_opus(audio, bit_rate))
+            else:
+                ffmpeg.input("pipe:0").output(
+                    str(opus_path),
+                    format="webm",
+                    acodec="libopus",
+                    audio_bitrate=bit_rate,
+                    application="voip",
+                ).run(input=audio, quiet=True, overwrite_output=True)
+            return opus_path
+        except (ffmpeg.Error, _AV_ERRORS) as exc:
+            opus_path.unlink(missing_ok=True)
+            current_app.logger.warning(
+                "Opus encoding failed, serving %s: %s", native_suffix, getattr(exc, "stderr", None) or exc
+            )
+
+    path = path.with_suffix(native_suffix)
+    path.write_bytes(audio)
+    return path
+
+
+def _encode_opus(audio: bytes, bit_rate: int) -> bytes:
+    """Re-encode WAV/MP3 bytes to mono Opus in WebM in-process with PyAV."""
+
+    out = io.BytesIO()
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=48000)
+    with av.open(io.BytesIO(audio)) as source, av.open(out, "w", format="webm") as target:
+        stream = target.add_stream("libopus", rate=48000, options={"application": "voip"})
+        stream.bit_rate = bit_rate
+        stream.layout = "mono"
+        for frame in source.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                target.mux(stream.encode(resampled))
+        for resampled in resampler.resample(None):
+            target.mux(stream.encode(resampled))
+        target.mux(stream.encode(None))
+    return out.getvalue()
+
+
+def _tts_voice() -> tuple[str, str]:
+    """Return the active voice identifier and the file suffix it produces."""
+
+    if current_app.extensions.get("ai_tts") is not None:
+        voice_path = current_app.config.get("AI_PIPER_VOICE") or os.getenv("AI_PIPER_VOICE")
+        voice, suffix = f"piper:{voice_path}", ".wav"
+    else:
+        voice, suffix = "gtts:en", ".mp3"
+    if current_app.config.get("AI_TTS_FORMAT") == "webm":
+        suffix = ".webm"
+    return voice, suffix
+
+
+def _synthesize_cached(text: str, audio_folder: Path) -> Path:
+    """Synthesise ``text`` unless identical audio for the active voice exists."""
+
+    limit = current_app.config.get("AI_TTS_CACHE_SIZE", 0)
+    if limit <= 0:
+        return synthesize_conversational(text, audio_folder / f"resp_{uuid.uuid4().hex}.mp3")
+
+    voice, suffix = _tts_voice()
+    digest = hashlib.sha256(f"{voice}\0{text}".encode("utf-8")).hexdigest()[:16]
+    cache_path = audio_folder / f"{_TTS_CACHE_PREFIX}{digest}{suffix}"
+    with _TTS_CACHE_LOCK:
+        # Match on the digest: a failed Opus encode stores the native format,
+        # which must still count as a hit for later requests.
+        for candidate_suffix in dict.fromkeys((suffix, *_AUDIO_SUFFIXES)):
+            candidate = cache_path.with_suffix(candidate_suffix)
+            if candidate.exists():
+                _TTS_CACHE[candidate.name] = candidate
+                _TTS_CACHE.move_to_end(candidate.name)
+                return candidate
+
+    # Write under a unique name and rename so concurrent requests for the same
+    # text never observe a partially written file.
+    partial_path = cache_path.with_name(f"{cache_path.stem}.{uuid.uuid4().hex[:8]}{suffix}")
+    try:
+        written = synthesize_conversational(text, partial_path)
+    except Exception:
+        partial_path.unlink(missing_ok=True)
+        raise
+    # A failed Opus encode falls back to the native format.
+    cache_path = cache_path.with_suffix(written.suffix)
+    os.replace(written, cache_path)
+    with _TTS_CACHE_LOCK:
+        _TTS_CACHE[cache_path.name] = cache_path
+        _TTS_CACHE.move_to_end(cache_path.name)
+        _evict_tts_cache(limit)
+    return cache_path
+
+
+def _evict_tts_cache(limit: int) -> None:
+    while len(_TTS_CACHE) > limit:
+        _, stale = _TTS_CACHE.popitem(last=False)
+        stale.unlink(missing_ok=True)
+
+
+def _load_tts_cache(audio_folder: Path, limit: int) -> None:
+    """Adopt cached audio left by a previous run so it stays bounded."""
+
+    if limit <= 0:
+        return
+    files = []
+    for path in audio_folder.glob(f"{_TTS_CACHE_PREFIX}*"):
+        if "." in path.stem:
+            # Partial output from an interrupted synthesis.
+            path.unlink(missing_ok=True)
+        elif path.suffix in _AUDIO_SUFFIXES:
+            files.append(path)
+    files.sort(key=lambda path: path.stat().st_mtime)
+    with _TTS_CACHE_LOCK:
+        for path in files:
+            _TTS_CACHE[path.name] = path
+        _evict_tts_cache(limit)
+
+
+def _normalize_utterance(text: str) -> str:
+    return " ".join(_UTTERANCE_PATTERN.sub(" ", text.lower()).split())
+
+
+def _response_cache_key(history: list[dict], transcript: str) -> tuple[str, str] | None:
+    """Key a turn on the user's utterance and a digest of the history before it."""
+
+    utterance = _normalize_utterance(transcript)
+    if not utterance:
+        return None
+    digest = hashlib.sha256()
+    for entry in history:
+        digest.update(f"{entry.get('author')}\0{_normalize_utterance(entry.get('text') or '')}\0".encode("utf-8"))
+    return digest.hexdigest(), utterance
+
+
+def _cached_response(key: tuple[str, str] | None) -> str | None:
+    if key is None:
+        return None
+    with _RESPONSE_CACHE_LOCK:
+        cached = _RESPONSE_CACHE.get(key)
+        if cached is None:
+            return None
+        expires_at, response_text = cached
+        if time.monotonic() >= expires_at:
+            del _RESPONSE_CACHE[key]
+            return None
+        _RESPONSE_CACHE.move_to_end(key)
+        return response_text
+
+
+def _remember_response(key: tuple[str, str] | None, response_text: str) -> None:
+    limit = current_app.config.get("AI_RESPONSE_CACHE_SIZE", 0)
+    if key is None or not response_text or limit <= 0:
+        return
+    expires_at = time.monotonic() + current_app.config.get("AI_RESPONSE_CACHE_TTL", 300)
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = (expires_at, response_text)
+        _RESPONSE_CACHE.move_to_end(key)
+        while len(_RESPONSE_CACHE) > limit:
+            _RESPONSE_CACHE.popitem(last=False)
+
+
+def _history_key() -> str:
+    key = session.get("ai_history_id")
+    if not key:
+        key = uuid.uuid4().hex
+        session["ai_history_id"] = key
+    return key
+
+
+def _get_history(key: str) -> list[dict]:
+    with _HISTORY_LOCK:
+        history = _HISTORY.get(key)
+        if history is None:
+            return []
+        _HISTORY.move_to_end(key)
+        return [entry for entry, _ in history["messages"]]
+
+
+def _append_history(key: str, *entries: dict) -> None:
+    max_messages = current_app.config.get("AI_HISTORY_MAX_MESSAGES", 50)
+    max_words = current_app.config.get("AI_HISTORY_MAX_WORDS", 3000)
+    max_sessions = current_app.config.get("AI_HISTORY_MAX_SESSIONS", 1024)
+    with _HISTORY_LOCK:
+        history = _HISTORY.get(key)
+        if history is None:
+            history = _HISTORY[key] = {"messages": deque(), "words": 0}
+        messages = history["messages"]
+        for entry in entries:
+            words = len((entry.get("text") or "").split())
+            messages.append((entry, words))
+            history["words"] += words
+        # Always keep the newest entry, even if it alone exceeds the budget.
+        while len(messages) > 1 and (
+            len(messages) > max_messages or history["words"] > max_words
+        ):
+            _, words = messages.popleft()
+            history["words"] -= words
+        _HISTORY.move_to_end(key)
+        while len(_HISTORY) > max_sessions:
+            _HISTORY.popitem(last=False)
+
+
+__all__ = [
+    "bp",
+    "init_app",
+    "call_gemini_api",
+    "cleanup_audio",
+    "recognize_speech",
+    "stream_gemini_api",
+    "synthesize_conversational",
+]
 
 
@@ -1,24 +1,35 @@
 from __future__ import annotations
 
-import difflib
+import heapq
+import io
 import json
 import os
 import re
 import stat
-import tempfile
-import uuid
+import string
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from typing import Any, Optional, TYPE_CHECKING
 from urllib.parse import urljoin, urlparse
 
 from dotenv import load_dotenv
-from flask import Flask, abort, flash, jsonify, redirect, render_template, request, url_for
+from flask import Flask, Response, abort, flash, jsonify, redirect, render_template, request, url_for
+from flask.json.provider import DefaultJSONProvider
 from ai_app import bp as ai_bp, init_app as init_ai_app
 from flask_login import (LoginManager, UserMixin, current_user, login_required,
                          login_user, logout_user)
-import whisper
-from werkzeug.security import check_password_hash, generate_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+import ctranslate2
+import numpy as np
+import orjson
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
+from rapidfuzz import fuzz
+from werkzeug.security import check_password_hash
 
 try:
     import firebase_admin
@@ -55,7 +66,27 @@ def write_firebase_credentials():
 
 write_firebase_credentials()
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Serve ``jsonify``/``request.get_json`` through orjson's C encoder."""
+
+    option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=self.option).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        # Hand orjson's bytes straight to the response instead of round-tripping through str.
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 init_ai_app(app)
 app.register_blueprint(ai_bp)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "change-me")
@@ -64,10 +95,56 @@ login_manager.login_view = "login"
 login_manager.login_message_category = "info"
 
 EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+_HAS_LETTER = re.compile(r"[A-Za-z]").search
+_HAS_DIGIT = re.compile(r"[0-9]").search
 ROLE_OPTIONS = {"admin", "user"}
 USERS: dict[str, dict[str, str]] = {}
+# Monotonic time of the last full users sync; writes reset it to force a re-read.
+_USERS_CACHE_TS = 0.0
+_USERS_CACHE_TTL = float(os.environ.get("USERS_CACHE_TTL_SECONDS", 30))
 
 IST = timezone(timedelta(hours=5, minutes=30))
+_MIN_IST = datetime.min.replace(tzinfo=IST)
+
+
+class _NormalizeTable(dict):
+    """``str.translate`` table keeping ``[a-z0-9]`` and blanking everything else.
+
+    Entries are filled lazily so non-ASCII characters (curly quotes, dashes)
+    are handled without precomputing the whole Unicode range.
+    """
+
+    _KEEP = frozenset(map(ord, string.ascii_lowercase + string.digits))
+
+    def __missing__(self, codepoint: int) -> int | str:
+        value = codepoint if codepoint in self._KEEP else " "
+        self[codepoint] = value
+        return value
+
+
+_NORMALIZE_TABLE = _NormalizeTable()
+
+
+_PASSWORD_HASHER = PasswordHasher()
+
+
+def _hash_password(password: str) -> str:
+    return _PASSWORD_HASHER.hash(password)
+
+
+def _verify_password(password_hash: str, password: str) -> bool:
+    # Accounts created before the switch to Argon2 still carry werkzeug hashes.
+    if not password_hash.startswith("$argon2"):
+        return check_password_hash(password_hash, password)
+    try:
+        return _PASSWORD_HASHER.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def _invalidate_users_cache() -> None:
+    global _USERS_CACHE_TS
+    _USERS_CACHE_TS = 0.0
 
 
 def _store_user(email: str, password_hash: str, role: str = "user") -> None:
@@ -78,30 +155,57 @@ def _store_user(email: str, password_hash: str, role: str = "user") -> None:
     }
     USERS[email.lower()] = record
     _persist_user_to_firestore(record)
+    _invalidate_users_cache()
 
 
-def _persist_user_to_firestore(record: dict[str, str]) -> None:
-    if firestore is None:
-        return
+def _user_payload(record: dict[str, str]) -> Optional[dict[str, Any]]:
     email = (record.get("email") or "").strip()
     password_hash = record.get("password_hash")
     if not email or not password_hash:
-        return
-    client = _get_firestore_client()
-    if client is None:
-        return
-    payload = {
+        return None
+    return {
         "email": email,
         "role": record.get("role", "user"),
         "password_hash": password_hash,
         "updated_at": firestore.SERVER_TIMESTAMP,
     }
+
+
+def _persist_user_to_firestore(record: dict[str, str]) -> None:
+    if firestore is None:
+        return
+    payload = _user_payload(record)
+    if payload is None:
+        return
+    client = _get_firestore_client()
+    if client is None:
+        return
     try:
-        client.collection("users").document(email.lower()).set(payload, merge=True)
+        client.collection("users").document(payload["email"].lower()).set(payload, merge=True)
     except Exception as exc:  # pragma: no cover - remote call safety
         app.logger.warning("Failed to persist user to Firestore: %s", exc)
 
 
+def _rename_user_in_firestore(original_email: str, record: dict[str, str]) -> None:
+    """Write ``record`` under its new email and drop the old document in one commit."""
+    if firestore is None:
+        return
+    payload = _user_payload(record)
+    if payload is None:
+        return
+    client = _get_firestore_client()
+    if client is None:
+        return
+    users = client.collection("users")
+    batch = client.batch()
+    batch.set(users.document(payload["email"].lower()), payload, merge=True)
+    batch.delete(users.document(original_email.lower()))
+    try:
+        batch.commit()
+    except Exception as exc:  # pragma: no cover - remote call safety
+        app.logger.warning("Failed to rename user in Firestore: %s", exc)
+
+
 
 def _fetch_user_from_firestore(email: str) -> Optional[dict[str, str]]:
     if not email:
@@ -149,6 +253,9 @@ def _delete_user_from_firestore(email: str) -> None:
 
 
 def _refresh_users_from_firestore() -> None:
+    global _USERS_CACHE_TS
+    if _USERS_CACHE_TS and time.monotonic() - _USERS_CACHE_TS < _USERS_CACHE_TTL:
+        return
     client = _get_firestore_client()
     if client is None:
         return
@@ -157,6 +264,7 @@ def _refresh_users_from_firestore() -> None:
     except Exception as exc:  # pragma: no cover - remote call safety
         app.logger.warning("Failed to refresh users from Firestore: %s", exc)
         return
+    fetched: dict[str, dict[str, str]] = {}
     for document in documents:
         data = document.to_dict() or {}
         email = (data.get("email") or document.id or "").strip()
@@ -164,11 +272,13 @@ def _refresh_users_from_firestore() -> None:
         if not email or not password_hash:
             continue
         role = data.get("role", "user")
-        USERS[email.lower()] = {
+        fetched[email.lower()] = {
             "email": email,
             "password_hash": password_hash,
             "role": role,
         }
+    USERS.update(fetched)
+    _USERS_CACHE_TS = time.monotonic()
 
 
 SENTENCES = [
@@ -184,25 +294,58 @@ PARAGRAPHS = [
     {"id": 103, "text": "Try to spend 15 minutes every day reading English texts. Find a comfortable spot where you can focus on a book, an article, etc. without the risk of being interrupted. Don’t know what to read? Try news websites like the BBC for free daily articles featuring easy-to-read paragraphs to improve your English."},
 ]
 
+SENTENCES_BY_ID = {item["id"]: item for item in SENTENCES}
+PARAGRAPHS_BY_ID = {item["id"]: item for item in PARAGRAPHS}
+CONTENT_TYPES = frozenset({"sentence", "paragraph"})
+
 WHISPER_MODEL_NAME = os.environ.get("WHISPER_MODEL", "base")
 MODEL_CACHE_DIR = Path(os.environ.get("WHISPER_CACHE_DIR", Path.cwd() / "models"))
-_MODEL: Optional[whisper.Whisper] = None
-
-
-PROGRESS_CACHE: dict[str, list[dict[str, Any]]] = {}
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE") or ("cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu")
+WHISPER_COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE") or ("float16" if WHISPER_DEVICE == "cuda" else "int8")
+WHISPER_NUM_WORKERS = int(os.environ.get("WHISPER_NUM_WORKERS", min(2, os.cpu_count() or 1)))
+WHISPER_TIMEOUT_SECONDS = float(os.environ.get("WHISPER_TIMEOUT_SECONDS", 30))
+_MODEL: Optional[BatchedInferencePipeline] = None
+_MODEL_LOCK = threading.Lock()
+# CTranslate2 runs ``num_workers`` transcriptions in parallel; this pool feeds
+# it so concurrent requests overlap instead of queueing on one another.
+_TRANSCRIBE_POOL = ThreadPoolExecutor(max_workers=WHISPER_NUM_WORKERS, thread_name_prefix="whisper")
+
+
+PROGRESS_CACHE: dict[str, deque[dict[str, Any]]] = {}
+PROGRESS_CACHE_LIMIT = 100
 FIREBASE_APP: Any | None = None
 FIRESTORE_CLIENT: Any | None = None
+# Guards the one-time Firebase/Firestore setup; the client itself is thread-safe
+# and shared by every request, so it must only ever be created here.
+_FIREBASE_LOCK = threading.Lock()
+_FIREBASE_INIT_FAILED = False
+# Progress writes run here so /transcribe doesn't wait on the Firestore round trip.
+_PROGRESS_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="progress")
 
 
 
 def init_firebase() -> None:
-    """Initialise a Firebase app if credentials are available."""
-    global FIREBASE_APP, FIRESTORE_CLIENT
-    if FIRESTORE_CLIENT is not None:
+    """Initialise a Firebase app if credentials are available.
+
+    The resulting ``FIRESTORE_CLIENT`` is a process-wide singleton: its gRPC
+    channel multiplexes concurrent calls, so all threads share it.
+    """
+    global _FIREBASE_INIT_FAILED
+    if FIRESTORE_CLIENT is not None or _FIREBASE_INIT_FAILED:
         return
     if firebase_admin is None or credentials is None or firestore is None:
         return
+    with _FIREBASE_LOCK:
+        if FIRESTORE_CLIENT is None and not _FIREBASE_INIT_FAILED:
+            _init_firebase_locked()
+            # Don't re-probe credentials on every request once setup has failed.
+            _FIREBASE_INIT_FAILED = FIRESTORE_CLIENT is None
+    if FIRESTORE_CLIENT is not None:
+        _refresh_users_from_firestore()
+
 
+def _init_firebase_locked() -> None:
+    global FIREBASE_APP, FIRESTORE_CLIENT
     try:
         FIREBASE_APP = firebase_admin.get_app()  # type: ignore[assignment]
     except ValueError:
@@ -230,8 +373,6 @@ def init_firebase() -> None:
     except Exception as exc:  # pragma: no cover - startup safety
         app.logger.warning("Firestore client initialisation failed: %s", exc)
         FIRESTORE_CLIENT = None
-    else:
-        _refresh_users_from_firestore()
 
 
 
@@ -255,10 +396,13 @@ DEFAULT_ADMIN_PASSWORD = (
     or "practice123"
 )
 if DEFAULT_ADMIN_EMAIL and DEFAULT_ADMIN_PASSWORD:
-    _store_user(DEFAULT_ADMIN_EMAIL, generate_password_hash(DEFAULT_ADMIN_PASSWORD), role="admin")
+    _store_user(DEFAULT_ADMIN_EMAIL, _hash_password(DEFAULT_ADMIN_PASSWORD), role="admin")
 
 def _coerce_timestamp(value: Any) -> datetime:
     if isinstance(value, datetime):
+        # Firestore returns tz-aware UTC datetimes, so this is the common path.
+        if value.tzinfo is not None:
+            return value.astimezone(IST)
         dt = value
     elif isinstance(value, str):
         try:
@@ -279,7 +423,7 @@ def save_progress_entry(user_id: str, content: dict[str, Any], transcript: str,
         return
     created_at = datetime.now(IST)
     entry = {
-        "id": uuid.uuid4().hex,
+        "id": os.urandom(16).hex(),
         "sentence_id": content.get("id"),
         "content_type": content_type,
         "target": content.get("text"),
@@ -288,17 +432,21 @@ def save_progress_entry(user_id: str, content: dict[str, Any], transcript: str,
         "created_at": created_at,
     }
 
+    history = PROGRESS_CACHE.get(user_id)
+    if history is None:
+        history = PROGRESS_CACHE[user_id] = deque(maxlen=PROGRESS_CACHE_LIMIT)
+    history.append(entry)
+
     client = _get_firestore_client()
     if client is not None:
-        try:
-            client.collection("users").document(user_id).collection("sessions").document(entry["id"]).set(entry)
-        except Exception as exc:  # pragma: no cover - remote call safety
-            app.logger.warning("Failed to persist progress to Firestore: %s", exc)
+        _PROGRESS_POOL.submit(_write_progress_entry, client, user_id, entry)
 
-    history = PROGRESS_CACHE.setdefault(user_id, [])
-    history.append(entry)
-    if len(history) > 100:
-        del history[:-100]
+
+def _write_progress_entry(client: Any, user_id: str, entry: dict[str, Any]) -> None:
+    try:
+        client.collection("users").document(user_id).collection("sessions").document(entry["id"]).set(entry)
+    except Exception as exc:  # pragma: no cover - remote call safety
+        app.logger.warning("Failed to persist progress to Firestore: %s", exc)
 
 
 
@@ -323,9 +471,18 @@ def fetch_progress_entries(user_id: str, limit: int = 50) -> list[dict[str, Any]
         except Exception as exc:  # pragma: no cover - remote call safety
             app.logger.warning("Failed to load progress from Firestore: %s", exc)
 
-    if not entries:
-        fallback = PROGRESS_CACHE.get(user_id, [])
-        entries = sorted(fallback, key=lambda item: item.get("created_at", datetime.min.replace(tzinfo=IST)), reverse=True)[:limit]
+    # Snapshot the deque: request threads may append to it while we read.
+    cached = tuple(PROGRESS_CACHE.get(user_id, ()))
+    if entries and cached:
+        # Writes land in Firestore asynchronously, so sessions saved moments
+        # ago may exist only in the cache; merge those in ahead of the query.
+        newest = entries[0]["created_at"]
+        seen = {entry.get("id") for entry in entries}
+        pending = [item for item in cached if item.get("created_at", _MIN_IST) > newest and item.get("id") not in seen]
+        if pending:
+            entries = heapq.nlargest(limit, [*pending, *entries], key=lambda item: item.get("created_at", _MIN_IST))
+    elif not entries:
+        entries = heapq.nlargest(limit, cached, key=lambda item: item.get("created_at", _MIN_IST))
 
     return entries
 
@@ -403,7 +560,7 @@ def _is_safe_redirect(target: Optional[str]) -> bool:
 def _validate_email(email: str) -> Optional[str]:
     if not email:
         return "Email is required."
-    if not EMAIL_PATTERN.match(email):
+    if not EMAIL_PATTERN.fullmatch(email):
         return "Enter a valid email address."
     return None
 
@@ -415,9 +572,9 @@ def _validate_password(password: str) -> list[str]:
         return errors
     if len(password) < 8:
         errors.append("Password must be at least 8 characters long.")
-    if not re.search(r"[A-Za-z]", password):
+    if not _HAS_LETTER(password):
         errors.append("Password must include at least one letter.")
-    if not re.search(r"[0-9]", password):
+    if not _HAS_DIGIT(password):
         errors.append("Password must include at least one number.")
     return errors
 
@@ -431,44 +588,86 @@ def _require_admin() -> None:
         abort(403)
 
 
-def load_model() -> whisper.Whisper:
+def _whisper_model_source() -> str:
+    """Prefer a pre-quantised CTranslate2 build (see RENDER_WHISPER_SETUP.md) over a hub download."""
+    converted = MODEL_CACHE_DIR / f"whisper-{WHISPER_MODEL_NAME}-int8"
+    if (converted / "model.bin").is_file():
+        return str(converted)
+    return WHISPER_MODEL_NAME
+
+
+def load_model() -> BatchedInferencePipeline:
     global _MODEL
-    if _MODEL is None:
-        try:
-            MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
-            app.logger.info(f"Loading Whisper model '{WHISPER_MODEL_NAME}' to {MODEL_CACHE_DIR}")
-            _MODEL = whisper.load_model(WHISPER_MODEL_NAME, download_root=str(MODEL_CACHE_DIR))
-            app.logger.info("Whisper model loaded successfully")
-        except Exception as exc:
-            app.logger.error(f"Failed to load Whisper model: {exc}")
-            raise RuntimeError(f"Could not initialize Whisper model: {exc}")
+    if _MODEL is not None:
+        return _MODEL
+    with _MODEL_LOCK:
+        if _MODEL is None:
+            try:
+                MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                app.logger.info(
+                    f"Loading Whisper model '{WHISPER_MODEL_NAME}' to {MODEL_CACHE_DIR} "
+                    f"({WHISPER_DEVICE}, {WHISPER_COMPUTE_TYPE})"
+                )
+                model = WhisperModel(
+                    _whisper_model_source(),
+                    device=WHISPER_DEVICE,
+                    compute_type=WHISPER_COMPUTE_TYPE,
+                    num_workers=WHISPER_NUM_WORKERS,
+                    download_root=str(MODEL_CACHE_DIR),
+                )
+                _MODEL = BatchedInferencePipeline(model=model)
+                app.logger.info("Whisper model loaded successfully")
+            except Exception as exc:
+                app.logger.error(f"Failed to load Whisper model: {exc}")
+                raise RuntimeError(f"Could not initialize Whisper model: {exc}")
     return _MODEL
 
 
-def initialize_model_on_startup():
-    """Pre-load the Whisper model during app startup to avoid first-request timeout."""
+def _warm_model() -> None:
+    """Load the model and push one second of silence through the encoder and decoder."""
     try:
         app.logger.info("Pre-loading Whisper model during startup...")
-        load_model()
+        model = load_model().model
+        # Bypass VAD, which would drop pure silence before the encoder ever ran.
+        segments, _info = model.transcribe(np.zeros(16000, dtype=np.float32), language="en", vad_filter=False)
+        for _segment in segments:
+            pass
         app.logger.info("✓ Whisper model ready")
     except Exception as exc:
         app.logger.warning(f"Could not pre-load model at startup: {exc}")
         app.logger.warning("Model will be loaded on first transcription request")
 
 
+def initialize_model_on_startup():
+    """Warm the Whisper model in the background so startup and the first request don't block."""
+    threading.Thread(target=_warm_model, name="whisper-warmup", daemon=True).start()
+
+
+def _run_transcription(audio_bytes: bytes) -> str:
+    # Decode the upload in memory (PyAV) straight to 16 kHz mono float32.
+    audio = decode_audio(io.BytesIO(audio_bytes), sampling_rate=16000)
+    segments, _info = load_model().transcribe(audio, language="en", batch_size=8, vad_filter=True)
+    return "".join(segment.text for segment in segments).strip()
+
+
 def normalize_text(value: str) -> str:
-    cleaned = re.sub(r"[^a-z0-9\s]", " ", value.lower())
-    return " ".join(cleaned.split())
+    return " ".join(value.lower().translate(_NORMALIZE_TABLE).split())
+
+
+# Practice texts never change, so their normalised form is computed once here
+# rather than on every /transcribe call.
+_NORMALIZED_REFERENCES = {item["text"]: normalize_text(item["text"]) for item in (*SENTENCES, *PARAGRAPHS)}
 
 
 def calculate_similarity(reference: str, attempt: str) -> float:
-    reference_normalized = normalize_text(reference)
+    reference_normalized = _NORMALIZED_REFERENCES.get(reference)
+    if reference_normalized is None:
+        reference_normalized = normalize_text(reference)
     attempt_normalized = normalize_text(attempt)
     if not reference_normalized or not attempt_normalized:
         return 0.0
 
-    ratio = difflib.SequenceMatcher(None, reference_normalized, attempt_normalized).ratio()
-    return round(ratio * 100, 2)
+    return round(fuzz.ratio(reference_normalized, attempt_normalized), 2)
 
 
 @app.get("/")
@@ -498,7 +697,7 @@ def transcribe():
 
     content_type_raw = request.form.get("contentType", "sentence")
     content_type = (content_type_raw or "sentence").strip().lower()
-    if content_type not in {"sentence", "paragraph"}:
+    if content_type not in CONTENT_TYPES:
         return jsonify({"error": "Invalid content type."}), 400
 
     content_id = request.form.get("contentId") or request.form.get("sentenceId")
@@ -510,8 +709,8 @@ def transcribe():
     except ValueError:
         return jsonify({"error": "Content identifier must be an integer."}), 400
 
-    items = SENTENCES if content_type == "sentence" else PARAGRAPHS
-    content = next((item for item in items if item["id"] == content_id_int), None)
+    items = SENTENCES_BY_ID if content_type == "sentence" else PARAGRAPHS_BY_ID
+    content = items.get(content_id_int)
     if content is None:
         label = "paragraph" if content_type == "paragraph" else "sentence"
         return jsonify({"error": f"{label.capitalize()} not found."}), 404
@@ -520,16 +719,21 @@ def transcribe():
     if audio_file.filename == "":
         return jsonify({"error": "Empty audio file."}), 400
 
-    temp_path: str | None = None
+    # Wait for the startup load here, outside the pool, so a first deploy's
+    # model download neither counts against the transcription timeout nor
+    # ties up the worker threads.
     try:
-        suffix = Path(audio_file.filename).suffix or ".webm"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_audio:
-            audio_file.save(temp_audio.name)
-            temp_path = temp_audio.name
-
-        model = load_model()
-        transcription = model.transcribe(temp_path, fp16=False, language="en")
-        transcript_text = transcription.get("text", "").strip()
+        load_model()
+    except RuntimeError as exc:
+        return jsonify({"error": "Speech model is unavailable.", "details": str(exc)}), 503
+
+    try:
+        future = _TRANSCRIBE_POOL.submit(_run_transcription, audio_file.read())
+        try:
+            transcript_text = future.result(timeout=WHISPER_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            future.cancel()
+            return jsonify({"error": "Transcription timed out."}), 504
         similarity_score = calculate_similarity(content["text"], transcript_text)
 
         response_payload = {
@@ -554,14 +758,6 @@ def transcribe():
         return jsonify(response_payload)
     except Exception as exc:  # pragma: no cover - safety net for runtime issues
         return jsonify({"error": "Transcription failed.", "details": str(exc)}), 500
-    finally:
-        if temp_path:
-            temp_file = Path(temp_path)
-            if temp_file.exists():
-                try:
-                    temp_file.unlink()
-                except OSError:
-                    pass
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -581,7 +777,7 @@ def login():
             next_url = form_next
 
         record = USERS.get(email_raw.lower()) or _fetch_user_from_firestore(email_raw)
-        if record and check_password_hash(record["password_hash"], password):
+        if record and _verify_password(record["password_hash"], password):
             login_user(User(record["email"], record.get("role", "user")))
             flash("Welcome back!", "success")
             return redirect(next_url)
@@ -629,7 +825,7 @@ def register():
                 form_email=email_raw,
             )
 
-        _store_user(email_raw, generate_password_hash(password), role="user")
+        _store_user(email_raw, _hash_password(password), role="user")
         login_user(User(email_raw, "user"))
         flash("Registration successful!", "success")
         redirect_target = request.form.get("next") or next_url
@@ -716,7 +912,7 @@ def _admin_create_user() -> None:
             flash(err, "error")
         return
 
-    _store_user(email_raw, generate_password_hash(password), role=role)
+    _store_user(email_raw, _hash_password(password), role=role)
     flash("User created successfully.", "success")
 
 
@@ -769,16 +965,18 @@ def _admin_update_user() -> None:
     new_record["email"] = new_email
     new_record["role"] = role
     if password:
-        new_record["password_hash"] = generate_password_hash(password)
+        new_record["password_hash"] = _hash_password(password)
 
     original_key = lookup_key
     new_key = new_email.lower()
     if original_key in USERS:
         del USERS[original_key]
     USERS[new_key] = new_record
-    _persist_user_to_firestore(new_record)
     if new_key != original_key and original_email:
-        _delete_user_from_firestore(original_email)
+        _rename_user_in_firestore(original_email, new_record)
+    else:
+        _persist_user_to_firestore(new_record)
+    _invalidate_users_cache()
 
     if current_user.is_authenticated and current_user.id.lower() == original_email.lower():
         login_user(User(new_record["email"], new_record.get("role", "user")))
@@ -809,6 +1007,7 @@ def _admin_delete_user() -> None:
         del USERS[lookup_key]
     if email_raw:
         _delete_user_from_firestore(email_raw)
+    _invalidate_users_cache()
     flash("User deleted.", "success")
 
 
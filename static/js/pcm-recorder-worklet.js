@@ -0,0 +1,13 @@
+// Forwards raw microphone samples (first channel) to the main thread so the
+// AI Companion page can build a 16 kHz mono WAV without server-side transcoding.
+class PcmRecorderProcessor extends AudioWorkletProcessor {
+  process(inputs) {
+    const channel = inputs[0] && inputs[0][0];
+    if (channel && channel.length) {
+      this.port.postMessage(channel.slice(0));
+    }
+    return true;
+  }
+}
+
+registerProcessor('pcm-recorder', PcmRecorderProcessor);